@@ -1,5 +1,6 @@
-__all__ = ['base', 'scheduler', 'queue']
+__all__ = ['base', 'scheduler', 'queue', 'stream_queue']
 
 from scheduler import Scheduler # convenience
 from queue import Queue
+from stream_queue import StreamQueue
 from base import ContentType
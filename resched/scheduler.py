@@ -1,12 +1,33 @@
 __author__ = 'Kiril Savino'
 
 import time
+import random
+import zlib
+from itertools import chain
 from redis import WatchError
 from base import RedisBacked
 import logging
 
 format_version = '0.1.0'
 
+def _utf8(value):
+    """
+    The bytes Redis stores for a (packed) value, which is what it hands back later.
+    """
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+def _at_most(score, max_time):
+    """
+    Whether a score falls under a ZRANGEBYSCORE-style upper bound, like 10, '+inf' or '(10'.
+    """
+    if not isinstance(max_time, basestring):
+        return score <= max_time
+    if max_time.startswith('('):
+        return score < float(max_time[1:])
+    return score <= float(max_time)
+
 class Scheduler(RedisBacked):
     """
     >>> import datetime
@@ -40,34 +61,137 @@ class Scheduler(RedisBacked):
     >>> scheduler.reschedule_dropped_items()
     >>> scheduler.is_scheduled(value)
     False
+    >>> past = datetime.datetime.now()-datetime.timedelta(seconds=120)
+    >>> scheduler.schedule('a', past, payload='aaa')
+    >>> scheduler.schedule('b', past+datetime.timedelta(seconds=100))
+    >>> scheduler.schedule('c', datetime.datetime.now()+datetime.timedelta(seconds=60))
+    >>> scheduler.count_due()
+    2
+    >>> [v for v, _, _, _ in scheduler.iter_scheduled(batch_size=1)]
+    ['a', 'b', 'c']
+    >>> items, cursor = scheduler.page_scheduled(count=2)
+    >>> [(v, p) for v, _, p, _ in items]
+    [('a', 'aaa'), ('b', 'b')]
+    >>> items, cursor = scheduler.page_scheduled(cursor=cursor, count=2)
+    >>> [v for v, _, _, _ in items], cursor
+    (['c'], None)
+    >>> scheduler.lateness_histogram(buckets=(0, 60))
+    [(0, 60, 1), (60, None, 1)]
+    >>> scheduler.pop_due(progress_ttl=30)
+    ('a', 'aaa')
+    >>> scheduler.schedule('d', past)
+    >>> scheduler.pop_due(progress_ttl=5)
+    ('d', 'd')
+    >>> scheduler.oldest_lease()[0]
+    'd'
+    >>> summary = scheduler.summary(buckets=(0, 60))
+    >>> summary['scheduled'], summary['in_progress'], summary['due']
+    (2, 2, 1)
+    >>> scheduler.page_scheduled(count=0)
+    Traceback (most recent call last):
+        ...
+    AssertionError: count must be at least 1
+    >>> sharded = Scheduler(Redis('localhost'), 'sharded', ContentType.STRING, partitions=4, preferred_partition=0)
+    >>> sharded.whipe()
+    >>> for value in 'abcdef':
+    ...     sharded.schedule(value, past)
+    >>> len(set(sharded._scheduled_key(value) for value in 'abcdef')) > 1
+    True
+    >>> sharded.count_scheduled(), sharded.count_due()
+    (6, 6)
+    >>> sharded.is_scheduled('c')
+    True
+    >>> sorted(sharded.pop_due()[0] for _ in range(6))
+    ['a', 'b', 'c', 'd', 'e', 'f']
+    >>> sharded.pop_due()
+    (None, None)
+    >>> sharded.count_scheduled(), sharded.count_in_progress()
+    (0, 6)
+    >>> sharded.schedule(u'caf\\xe9', past)
+    >>> sharded.is_scheduled(u'caf\\xe9')
+    True
+    >>> sharded.deschedule(u'caf\\xe9')
+    >>> sharded.is_scheduled(u'caf\\xe9')
+    False
+    >>> legacy = Scheduler(Redis('localhost'), 'sharded', ContentType.STRING)
+    >>> legacy.schedule('old', past)
+    >>> sharded.count_scheduled(), sharded.is_scheduled('old')
+    (1, True)
+    >>> sharded.pop_due()
+    ('old', 'old')
+    >>> legacy.count_scheduled()
+    0
     """
 
     __PROGRESS_TTL_SECONDS = 60
 
-    def __init__(self, redis_client, namespace, content_type):
+    def __init__(self, redis_client, namespace, content_type, partitions=1, preferred_partition=None):
         """
         Create a scheduler, in a namespace.
+
+        partitions:           (optional) the number of timelines to spread scheduled values over, by value hash [1]
+        preferred_partition:  (optional) the timeline this worker pops from first, before stealing from the others [random]
+
+        * every Scheduler on a namespace must use the same number of partitions.  Going from one
+          partition to several is safe, as the unpartitioned timeline keeps being read (last) until
+          it drains, but any other change strands whatever is already scheduled in the old timelines.
         """
         RedisBacked.__init__(self, redis_client, namespace, content_type)
+        assert partitions >= 1, "need at least one partition"
         self.SCHEDULED = 'schedule:{0}:waiting'.format(namespace)
+        if partitions == 1:
+            self.SCHEDULED_KEYS = [self.SCHEDULED]
+        else:
+            self.SCHEDULED_KEYS = ['{0}:{1}'.format(self.SCHEDULED, i) for i in range(partitions)]
+        # everything that might hold scheduled values, including the pre-partitioning timeline
+        self.TIMELINE_KEYS = self.SCHEDULED_KEYS if partitions == 1 else self.SCHEDULED_KEYS + [self.SCHEDULED]
+        if preferred_partition is None:
+            preferred_partition = random.randrange(partitions)
+        self.preferred_partition = preferred_partition % partitions
         self.INPROGRESS = 'schedule:{0}:inprogress'.format(namespace)
         self.PAYLOADS = 'schedule:{0}:payload'.format(namespace)
         self.EXPIRATIONS = 'schedule:{0}:expiration'.format(namespace)
         self.VERSION = 'schedule:{0}:version'.format(namespace)
         self.WORKING_TTL = 'schedule:{0}:working'.format(namespace)
+        self.LEASES = 'schedule:{0}:leases'.format(namespace)
 
     def whipe(self):
         for key in self.server.keys('schedule:{0}:*'.format(self.namespace)):
             self.server.delete(key)
 
+    def _scheduled_key(self, value):
+        """
+        The timeline a (packed) value lives in, stable across processes.
+        """
+        if len(self.SCHEDULED_KEYS) == 1:
+            return self.SCHEDULED
+        return self.SCHEDULED_KEYS[(zlib.crc32(_utf8(value)) & 0xffffffff) % len(self.SCHEDULED_KEYS)]
+
+    def _timelines_for(self, value):
+        """
+        Every timeline a (packed) value may be in: its own, plus the unpartitioned one if we're partitioned.
+        """
+        key = self._scheduled_key(value)
+        return [key] if key == self.SCHEDULED else [key, self.SCHEDULED]
+
+    def _pop_order(self):
+        """
+        The timelines in the order this worker pops from them: its preferred one, then the rest,
+        then whatever is left in the unpartitioned timeline.
+        """
+        start = self.preferred_partition
+        return self.SCHEDULED_KEYS[start:] + self.SCHEDULED_KEYS[:start] + self.TIMELINE_KEYS[len(self.SCHEDULED_KEYS):]
+
     def _clear_value(self, value, pipe=None):
         with pipe or self.server.pipeline() as pipe:
             pipe.multi()
-            pipe.zrem(self.SCHEDULED, value)
+            for key in self._timelines_for(value):
+                pipe.zrem(key, value)
             pipe.zrem(self.INPROGRESS, value)
             pipe.hdel(self.PAYLOADS, value)
             pipe.hdel(self.EXPIRATIONS, value)
             pipe.hdel(self.WORKING_TTL, value)
+            pipe.zrem(self.LEASES, value)
             # just to be safe, this is for the old storage format...
             pipe.delete(self._payload_key(value))
             # also for the old format...
@@ -77,9 +201,12 @@ class Scheduler(RedisBacked):
     def _reschedule_value(self, value, fire_time):
         with self.server.pipeline() as pipe:
             pipe.multi()
-            pipe.zadd(self.SCHEDULED, value, fire_time)
+            for key in self._timelines_for(value)[1:]:
+                pipe.zrem(key, value)
+            pipe.zadd(self._scheduled_key(value), value, fire_time)
             pipe.zrem(self.INPROGRESS, value)
             pipe.hdel(self.WORKING_TTL, value)
+            pipe.zrem(self.LEASES, value)
             # leave this here for backwards compat
             pipe.delete(self._working_lock_key(value))
             pipe.execute()
@@ -103,7 +230,9 @@ class Scheduler(RedisBacked):
 
         with self.server.pipeline() as pipe:
             pipe.multi()
-            pipe.zadd(self.SCHEDULED, value, fire_time) # for sorting
+            for key in self._timelines_for(value)[1:]:
+                pipe.zrem(key, value) # moving it out of the unpartitioned timeline
+            pipe.zadd(self._scheduled_key(value), value, fire_time) # for sorting
             pipe.hset(self.PAYLOADS, value, payload)
             if expire_time:
                 pipe.hset(self.EXPIRATIONS, value, expire_time)
@@ -147,14 +276,31 @@ class Scheduler(RedisBacked):
         * You've got a limited-time lock on the item, and must call complete() to prevent re-queue
         * You can govern that by passing 'progress_ttl' a custom # of seconds you'll have before your
           job goes back into the pool.
+        * With several partitions, the preferred timeline is tried first, then the others in turn,
+          so the result is due but not necessarily the globally earliest item.  All the timeline
+          heads are read in one round trip first, and only timelines with something due get WATCHed.
         """
+        time_now = time.time()
+        keys = self._pop_order()
+        if len(keys) > 1:
+            with self.server.pipeline(transaction=False) as pipe:
+                for key in keys:
+                    pipe.zrange(key, 0, 0, withscores=True)
+                heads = pipe.execute()
+            keys = [key for key, head in zip(keys, heads) if head and head[0][1] <= time_now]
+        for key in keys:
+            value, payload = self._pop_due_from(key, time_now, progress_ttl, destructively)
+            if value is not None:
+                return value, payload
+        return None, None
+
+    def _pop_due_from(self, key, time_now, progress_ttl, destructively):
         with self.server.pipeline() as pipe:
-            time_now = time.time()
             while True:
                 try:
-                    pipe.watch(self.SCHEDULED) # ensure we get a clean remove of the item
+                    pipe.watch(key) # ensure we get a clean remove of the item
 
-                    due_list = pipe.zrange(self.SCHEDULED, 0, 0, withscores=True)
+                    due_list = pipe.zrange(key, 0, 0, withscores=True)
                     if not due_list:
                         return None, None
                     value, scheduled_time = due_list[0]
@@ -191,16 +337,19 @@ class Scheduler(RedisBacked):
 
     def _start_work(self, value, scheduled_time, progress_ttl, pipe):
         pipe.multi()
-        pipe.zrem(self.SCHEDULED, value)
+        for key in self._timelines_for(value):
+            pipe.zrem(key, value)
         pipe.zadd(self.INPROGRESS, value, scheduled_time)
-        pipe.hset(self.WORKING_TTL, value, time.time() + progress_ttl)
+        lease_expire_time = time.time() + progress_ttl
+        pipe.hset(self.WORKING_TTL, value, lease_expire_time)
+        pipe.zadd(self.LEASES, value, lease_expire_time) # so the oldest lease is cheap to find
         pipe.execute()
 
     def _working_lock_key(self, value):
-        return 'schedule:{ns}:{value}:working'.format(ns=self.namespace, value=value)
+        return 'schedule:{ns}:{value}:working'.format(ns=self.namespace, value=_utf8(value))
 
     def _payload_key(self, value):
-        return 'schedule:{ns}:{val}'.format(ns=self.namespace, val=value)
+        return 'schedule:{ns}:{val}'.format(ns=self.namespace, val=_utf8(value))
 
     def complete(self, value):
         """
@@ -213,12 +362,237 @@ class Scheduler(RedisBacked):
         """
         self._clear_value(self.pack(value))
 
+    def _sum_over_timelines(self, command, *args):
+        """
+        Run a counting command against every timeline in one round trip, and add up the results.
+        """
+        with self.server.pipeline(transaction=False) as pipe:
+            for key in self.TIMELINE_KEYS:
+                getattr(pipe, command)(key, *args)
+            return int(sum(pipe.execute()))
+
     def count_scheduled(self):
-        return self.server.zcard(self.SCHEDULED)
+        return self._sum_over_timelines('zcard')
 
     def count_in_progress(self):
         return self.server.zcard(self.INPROGRESS)
 
+    def count_due(self, now=None):
+        """
+        Count the items that are currently due (the backlog), computed server-side.
+        """
+        now = time.time() if now is None else now
+        return self._sum_over_timelines('zcount', '-inf', now)
+
+    def _lateness_ranges(self, buckets, now):
+        """
+        Turn ascending lateness bucket boundaries (in seconds) into
+        (lower, upper, min_score, max_score) tuples, the last bucket being open-ended.
+        """
+        buckets = sorted(buckets)
+        ranges = []
+        for i, lower in enumerate(buckets):
+            upper = buckets[i + 1] if i + 1 < len(buckets) else None
+            min_score = '({0!r}'.format(now - upper) if upper is not None else '-inf'
+            ranges.append((lower, upper, min_score, now - lower))
+        return ranges
+
+    def lateness_histogram(self, buckets=(0, 60, 300, 900, 3600), now=None):
+        """
+        Bucket the due items by how late they are, using one ZCOUNT per bucket.
+
+        buckets:          (optional) ascending lateness boundaries, in seconds
+        now:              (optional) the timestamp to measure lateness against [time.time()]
+
+        * returns a list of (lower_seconds, upper_seconds, count), where the last upper bound is None
+        """
+        now = time.time() if now is None else now
+        ranges = self._lateness_ranges(buckets, now)
+        with self.server.pipeline(transaction=False) as pipe:
+            for _, _, min_score, max_score in ranges:
+                for key in self.TIMELINE_KEYS:
+                    pipe.zcount(key, min_score, max_score)
+            counts = self._bucket_sums(pipe.execute(), len(ranges))
+        return [(lower, upper, count) for (lower, upper, _, _), count in zip(ranges, counts)]
+
+    def _bucket_sums(self, counts, buckets):
+        """
+        Fold per-timeline counts (timelines varying fastest) into one count per bucket.
+        """
+        per_bucket = len(self.TIMELINE_KEYS)
+        return [int(sum(counts[i * per_bucket:(i + 1) * per_bucket])) for i in range(buckets)]
+
+    def oldest_lease(self):
+        """
+        Return (value, scheduled_time, lease_expire_time) for the in-progress item
+        whose lease runs out first, or None if no lease is held.
+
+        * items that went in progress before leases were tracked aren't considered
+        """
+        oldest = self.server.zrange(self.LEASES, 0, 0, withscores=True)
+        if not oldest:
+            return None
+        value, lease_expire_time = oldest[0]
+        return value, self.server.zscore(self.INPROGRESS, value), lease_expire_time
+
+    def summary(self, buckets=(0, 60, 300, 900, 3600), now=None):
+        """
+        Gather the monitoring counters for this schedule in a single round trip
+        (plus one for the oldest lease), without reading any of the sets in full.
+        """
+        now = time.time() if now is None else now
+        ranges = self._lateness_ranges(buckets, now)
+        keys = self.TIMELINE_KEYS
+        with self.server.pipeline(transaction=False) as pipe:
+            pipe.zcard(self.INPROGRESS)
+            for key in keys:
+                pipe.zcard(key)
+                pipe.zcount(key, '-inf', now)
+                pipe.zrange(key, 0, 0, withscores=True)
+            for _, _, min_score, max_score in ranges:
+                for key in keys:
+                    pipe.zcount(key, min_score, max_score)
+            results = pipe.execute()
+        in_progress = results[0]
+        per_key = results[1:1 + 3 * len(keys)]
+        next_due = [entries[0][1] for entries in per_key[2::3] if entries]
+        lateness = self._bucket_sums(results[1 + 3 * len(keys):], len(ranges))
+        return {
+            'scheduled': int(sum(per_key[0::3])),
+            'in_progress': in_progress,
+            'due': int(sum(per_key[1::3])),
+            'next_due_time': min(next_due) if next_due else None,
+            'lateness': [(lower, upper, count) for (lower, upper, _, _), count in zip(ranges, lateness)],
+            'oldest_lease': self.oldest_lease() if in_progress else None,
+            }
+
+    def _page(self, keys, min_time, max_time, cursor, count):
+        """
+        Read one page of one or more sorted sets by score, merged in (score, value) order.
+        The cursor holds, per key, the last (value, score) taken from it or None.  Each key
+        resumes from the rank of that value, so walking a big block of tied scores never
+        re-reads what was already returned.
+        """
+        assert count >= 1, "count must be at least 1"
+        positions = list(cursor) if cursor else [None] * len(keys)
+        with self.server.pipeline(transaction=False) as pipe:
+            for key, position in zip(keys, positions):
+                if position:
+                    pipe.zrank(key, position[0])
+                    pipe.zscore(key, position[0])
+            found = iter(pipe.execute())
+        spans = []
+        with self.server.pipeline(transaction=False) as pipe:
+            for key, position in zip(keys, positions):
+                if position is None:
+                    pipe.zrangebyscore(key, min_time, max_time, start=0, num=count, withscores=True)
+                    spans.append(1)
+                    continue
+                value, score = position
+                rank, current_score = next(found), next(found)
+                if rank is not None and current_score == score:
+                    pipe.zrange(key, rank + 1, rank + count, withscores=True)
+                    spans.append(1)
+                else:
+                    # the value moved since the last page: rescan the rest of its tied block once
+                    pipe.zrangebyscore(key, score, score, withscores=True)
+                    pipe.zrangebyscore(key, '({0!r}'.format(score), max_time, start=0, num=count, withscores=True)
+                    spans.append(2)
+            results = iter(pipe.execute())
+        candidates = []
+        for i, (position, span) in enumerate(zip(positions, spans)):
+            entries = list(chain(*[next(results) for _ in range(span)]))
+            if position:
+                entries = [(value, score) for value, score in entries
+                           if (score, value) > (position[1], position[0]) and _at_most(score, max_time)]
+            candidates.extend((score, value, i) for value, score in entries[:count])
+        candidates.sort()
+        taken = candidates[:count]
+        for score, value, i in taken:
+            positions[i] = (value, score)
+        entries = [(value, score) for score, value, _ in taken]
+        if len(entries) < count:
+            return entries, None
+        return entries, tuple(positions)
+
+    def _fetch_details(self, values, *hashes):
+        """
+        Batch-fetch payloads, plus the given per-value hashes, for a page of values.
+        """
+        if not values:
+            return [[] for _ in range(len(hashes) + 1)]
+        with self.server.pipeline(transaction=False) as pipe:
+            pipe.hmget(self.PAYLOADS, values)
+            for name in hashes:
+                pipe.hmget(name, values)
+            results = pipe.execute()
+        payloads = results[0]
+        missing = [i for i, payload in enumerate(payloads) if payload is None]
+        if missing:
+            # fall back to the old storage format, still in one round trip
+            with self.server.pipeline(transaction=False) as pipe:
+                for i in missing:
+                    pipe.get(self._payload_key(values[i]))
+                for i, payload in zip(missing, pipe.execute()):
+                    payloads[i] = payload
+        return [[self.unpack(payload) for payload in payloads]] + \
+            [[float(x) if x else None for x in result] for result in results[1:]]
+
+    def page_scheduled(self, min_time='-inf', max_time='+inf', cursor=None, count=100):
+        """
+        Return one page of scheduled items, and the cursor for the next page (None when done).
+
+        min_time:         (optional) the lowest scheduled timestamp to include ['-inf']
+        max_time:         (optional) the highest scheduled timestamp to include ['+inf']
+        cursor:           (optional) the cursor returned by the previous call
+        count:            (optional) the maximum number of items on the page [100]
+
+        * items are (value, scheduled_time, payload, expire_time) tuples
+        * paging is best-effort: items moved while you page may be skipped or repeated
+        """
+        entries, cursor = self._page(self.TIMELINE_KEYS, min_time, max_time, cursor, count)
+        values = [value for value, _ in entries]
+        payloads, expirations = self._fetch_details(values, self.EXPIRATIONS)
+        items = [(value, scheduled_time, payload, expire_time) for (value, scheduled_time), payload, expire_time
+                 in zip(entries, payloads, expirations)]
+        return items, cursor
+
+    def page_in_progress(self, min_time='-inf', max_time='+inf', cursor=None, count=100):
+        """
+        Same as page_scheduled(), but over in-progress items, which are
+        (value, scheduled_time, payload, lease_expire_time) tuples.
+        """
+        entries, cursor = self._page([self.INPROGRESS], min_time, max_time, cursor, count)
+        values = [value for value, _ in entries]
+        payloads, leases = self._fetch_details(values, self.WORKING_TTL)
+        items = [(value, scheduled_time, payload, lease) for (value, scheduled_time), payload, lease
+                 in zip(entries, payloads, leases)]
+        return items, cursor
+
+    def iter_scheduled(self, min_time='-inf', max_time='+inf', batch_size=100):
+        """
+        Generate every scheduled item in the score range, fetching batch_size at a time.
+        """
+        cursor = None
+        while True:
+            items, cursor = self.page_scheduled(min_time, max_time, cursor, batch_size)
+            for item in items:
+                yield item
+            if cursor is None:
+                return
+
+    def iter_in_progress(self, min_time='-inf', max_time='+inf', batch_size=100):
+        """
+        Generate every in-progress item in the score range, fetching batch_size at a time.
+        """
+        cursor = None
+        while True:
+            items, cursor = self.page_in_progress(min_time, max_time, cursor, batch_size)
+            for item in items:
+                yield item
+            if cursor is None:
+                return
+
     def is_expired(self, value):
         value = self.pack(value)
         expire_date = self.server.hget(self.EXPIRATIONS, value)
@@ -230,7 +604,11 @@ class Scheduler(RedisBacked):
 
     def is_scheduled(self, value):
         value = self.pack(value)
-        return self.server.zscore(self.SCHEDULED, value) is not None and not self.is_expired(value)
+        with self.server.pipeline(transaction=False) as pipe:
+            for key in self._timelines_for(value):
+                pipe.zscore(key, value)
+            scores = pipe.execute()
+        return any(score is not None for score in scores) and not self.is_expired(value)
 
     def reschedule_dropped_items(self):
         in_progress = self.server.zrange(self.INPROGRESS, 0, -1, withscores=True)
@@ -261,10 +639,13 @@ class Scheduler(RedisBacked):
         """
         Return the first non-expired and currently due item, without locking it in any way.
         """
-        next_one = self.server.zrange(self.SCHEDULED, 0, 0, withscores=True)
-        if not next_one:
+        with self.server.pipeline(transaction=False) as pipe:
+            for key in self.TIMELINE_KEYS:
+                pipe.zrange(key, 0, 0, withscores=True)
+            heads = [entries[0] for entries in pipe.execute() if entries]
+        if not heads:
             return None # schedule is empty
-        value, scheduled_time = next_one[0]
+        value, scheduled_time = min(heads, key=lambda entry: (entry[1], entry[0]))
         if scheduled_time > time.time():
             return None # not ready yet
         payload = self.server.hget(self.PAYLOADS, value) or self.server.get(self._payload_key(value))
@@ -0,0 +1,356 @@
+__author__ = 'Kiril Savino'
+
+from redis import ResponseError
+from base import ContentType
+from queue import Queue
+
+class StreamQueue(Queue):
+    """
+    A drop-in alternative to Queue built on a Redis Stream and a consumer group
+    (Redis >= 6.2), rather than lists plus per-worker working lists.
+
+    Popped items sit in the group's pending entries list until they're
+    acknowledged, so in-progress tracking is native.  Workers keep the same
+    active-key heartbeat as Queue, and reclaim_tasks() only claims the pending
+    entries of consumers whose heartbeat has lapsed, a batch at a time.
+
+    >>> from redis import Redis
+    >>> import time
+    >>> client = Redis('localhost')
+
+    >>> q = StreamQueue(client, 'stream_stuff', ContentType.JSON, track_entries=True)
+    >>> q.clear()
+    >>> assert q.size() == 0
+    >>> assert not q.peek()
+    >>> q.push({'hello': 'world'})
+    >>> q.peek()
+    {'hello': 'world'}
+    >>> q.contains({'hello': 'world'})
+    True
+    >>> q.pop()
+    {'hello': 'world'}
+    >>> q.size(), q.number_in_progress()
+    (0, 1)
+    >>> q.complete({'hello': 'world'})
+    >>> q.size(), q.number_in_progress()
+    (0, 0)
+    >>> q.contains({'hello': 'world'})
+    False
+    >>> q.number_active_workers()
+    1
+
+    >>> qa = StreamQueue(client, 'stream_stuff2', ContentType.STRING, worker_id='a', work_ttl=1)
+    >>> qb = StreamQueue(client, 'stream_stuff2', ContentType.STRING, worker_id='b', work_ttl=1)
+    >>> qa.clear()
+    >>> for value in ('x', 'y', 'z'):
+    ...     qa.push(value, value * 3)
+    >>> qb.pop_many(2, return_key=True)
+    [('x', 'xxx'), ('y', 'yyy')]
+    >>> qb.number_in_progress(), qa.number_in_progress(), qa.number_in_progress(all=True)
+    (2, 0, 2)
+    >>> qb.complete('x')
+    >>> qb.unpop('y')
+    >>> qa.pop(), qa.pop()
+    ('zzz', 'yyy')
+    >>> time.sleep(1.5)
+    >>> qb.reclaim_tasks()
+    >>> qa.number_in_progress(), qb.size()
+    (0, 2)
+    >>> qa.clear()
+    >>> qb.number_in_progress()
+    0
+    >>> qa.push('dup', 'first')
+    >>> qa.push('dup', 'second')
+    >>> qa.pop(), qb.pop()
+    ('second', 'second')
+    >>> qa.complete('dup')
+    >>> qa.number_in_progress(), qb.number_in_progress()
+    (0, 1)
+    >>> qb.complete('dup')
+    >>> qa.number_in_progress(all=True), qa.size()
+    (0, 0)
+
+    >>> first = StreamQueue(client, 'stream_abc')
+    >>> second = Queue(client, 'stream_abc_errors')
+    >>> first.clear()
+    >>> second.clear()
+    >>> first.pipe(Queue.RESULT_ERROR, second)
+    >>> first.push('a', 'aaa')
+    >>> first.pop(return_key=True)
+    ('a', 'aaa')
+    >>> first.complete('a', Queue.RESULT_ERROR)
+    >>> first.size(), second.size()
+    (0, 1)
+    >>> second.pop()
+    'aaa'
+    """
+
+    DEFAULT_GROUP = 'resched'
+    DEFAULT_RECLAIM_BATCH = 100
+
+    def __init__(self, redis_client, namespace, content_type=ContentType.STRING, **kwargs):
+        """
+        Takes the same arguments as Queue, except that only the 'fifo' strategy is supported.
+
+        @optional  group           the consumer group name, defaults to 'resched'
+        @optional  reclaim_batch   how many entries reclaim_tasks claims per call, defaults to 100
+        """
+        Queue.__init__(self, redis_client, namespace, content_type, **kwargs)
+        assert self.strategy == self.FIFO, "streams are strictly fifo"
+        self.group = kwargs.get('group', self.DEFAULT_GROUP)
+        self.reclaim_batch = kwargs.get('reclaim_batch', self.DEFAULT_RECLAIM_BATCH)
+        self.STREAM_KEY = 'queue.{ns}.stream'.format(ns=namespace)
+        self.PENDING_IDS = self._pending_ids_key()
+        self._group_ready = False
+
+    def _pending_ids_key(self, worker_id=None):
+        """
+        A hash of value -> comma-separated ids of the stream entries the worker has in progress for it.
+        """
+        worker_id = worker_id or self.worker_id
+        return 'queue.{ns}.stream.ids.{wid}'.format(ns=self.namespace, wid=worker_id)
+
+    def _ensure_group(self, force=False):
+        if self._group_ready and not force:
+            return
+        try:
+            self.server.execute_command('XGROUP', 'CREATE', self.STREAM_KEY, self.group, '0', 'MKSTREAM')
+        except ResponseError as e:
+            if 'BUSYGROUP' not in str(e):
+                raise
+        self._group_ready = True
+
+    def _command(self, *args, **options):
+        """
+        Run a consumer group command, recreating the group if someone cleared the queue under us.
+        """
+        self._ensure_group()
+        try:
+            return self.server.execute_command(*args, **options)
+        except ResponseError as e:
+            message = str(e).lower()
+            if 'nogroup' not in message and 'no such key' not in message:
+                raise
+            self._ensure_group(force=True)
+            return self.server.execute_command(*args, **options)
+
+    def _entries(self, reply):
+        """
+        Normalize stream entries to (id, value) pairs, whether or not the client parsed the reply.
+        """
+        entries = []
+        for entry in reply or []:
+            if entry is None:
+                continue
+            entry_id, fields = entry
+            if isinstance(fields, dict):
+                value = fields.get('value')
+            elif fields:
+                value = dict(zip(fields[::2], fields[1::2])).get('value')
+            else:
+                value = None # deleted while pending
+            entries.append((entry_id, value))
+        return entries
+
+    def _pending_summary(self):
+        """
+        Return (total pending, {consumer: pending}) for the group.
+        """
+        reply = self._command('XPENDING', self.STREAM_KEY, self.group)
+        if isinstance(reply, dict):
+            return int(reply['pending']), dict((c['name'], int(c['pending'])) for c in reply['consumers'] or [])
+        return int(reply[0]), dict((name, int(count)) for name, count in reply[3] or [])
+
+    def clear(self):
+        with self.server.pipeline() as pipe:
+            pipe.multi()
+            pipe.delete(self.STREAM_KEY)
+            pipe.delete(self.PENDING_IDS)
+            pipe.delete(self.ENTRY_SET_KEY)
+            pipe.delete(self.PAYLOADS)
+            pipe.delete(self.WORKING_ACTIVE_KEY)
+            for worker_id in self.server.smembers(self.WORKER_SET_KEY):
+                pipe.delete(self._pending_ids_key(worker_id))
+            pipe.delete(self.WORKER_SET_KEY)
+            pipe.execute()
+        self._group_ready = False
+
+    def reclaim_tasks(self):
+        """
+        Put everything held by workers whose active key has expired back on the queue,
+        like Queue.reclaim_tasks(), and forget those workers.
+        """
+        _, by_consumer = self._pending_summary()
+        workers = list(set(self.server.smembers(self.WORKER_SET_KEY)) | set(by_consumer))
+        with self.server.pipeline(transaction=False) as pipe:
+            for worker_id in workers:
+                pipe.get(self._working_active_key(worker_id))
+            active = pipe.execute()
+        for worker_id, is_active in zip(workers, active):
+            if is_active:
+                continue
+            if by_consumer.get(worker_id):
+                self._reclaim_from(worker_id)
+            with self.server.pipeline() as pipe:
+                pipe.multi()
+                pipe.delete(self._pending_ids_key(worker_id))
+                pipe.srem(self.WORKER_SET_KEY, worker_id)
+                pipe.execute()
+
+    def _reclaim_from(self, worker_id):
+        while True:
+            pending = self._command('XPENDING', self.STREAM_KEY, self.group, '-', '+',
+                                    self.reclaim_batch, worker_id, parse_detail=True)
+            entry_ids = [entry['message_id'] if isinstance(entry, dict) else entry[0] for entry in pending]
+            if not entry_ids:
+                return
+            args = ['XCLAIM', self.STREAM_KEY, self.group, self.worker_id, 0] + entry_ids
+            entries = self._entries(self._command(*args))
+            with self.server.pipeline() as pipe:
+                pipe.multi()
+                pipe.execute_command('XACK', self.STREAM_KEY, self.group, *entry_ids)
+                pipe.execute_command('XDEL', self.STREAM_KEY, *entry_ids)
+                for _, value in entries:
+                    if value is not None:
+                        pipe.execute_command('XADD', self.STREAM_KEY, '*', 'value', value)
+                pipe.execute()
+            if len(entry_ids) < self.reclaim_batch:
+                return
+
+    def size(self):
+        length = self.server.execute_command('XLEN', self.STREAM_KEY)
+        # acknowledged entries are deleted, so whatever isn't pending is waiting
+        return int(length - self._pending_summary()[0]) if length else 0
+
+    def number_in_progress(self, all=False):
+        total, by_consumer = self._pending_summary()
+        if all:
+            return total
+        return by_consumer.get(self.worker_id, 0)
+
+    def push(self, value, payload=None, pipeline=None, check=True):
+        with (pipeline or self.server.pipeline()) as pipe:
+            value = self.pack(value)
+            payload = self.pack(payload)
+            if not check or self._is_pushable(value):
+                pipe.execute_command('XADD', self.STREAM_KEY, '*', 'value', value)
+                if self.keep_entry_set:
+                    pipe.sadd(self.ENTRY_SET_KEY, value)
+            if payload:
+                pipe.hset(self.PAYLOADS, value, payload)
+            pipe.execute()
+
+    def _read(self, count, block_ms):
+        args = ['XREADGROUP', 'GROUP', self.group, self.worker_id, 'COUNT', count]
+        if block_ms is not None:
+            args += ['BLOCK', block_ms]
+        args += ['STREAMS', self.STREAM_KEY, '>']
+        reply = self._command(*args)
+        if not reply:
+            return []
+        return self._entries(reply[0][1])
+
+    def pop_many(self, count, destructively=False, return_key=False, block_ms=None):
+        """
+        Pop up to 'count' items in a single XREADGROUP.
+
+        @param count           The maximum number of items to pop.
+        @param destructively   Acknowledge (forget) the items immediately instead of tracking them.
+        @param return_key      Return (value, payload) tuples instead of payloads.
+        @param block_ms        Wait up to this many milliseconds for items (0 waits forever).
+        """
+        self._on_activity()
+        entries = self._read(count, block_ms)
+        if not entries:
+            return []
+        values = [value for _, value in entries]
+        pending_ids = {}
+        if not destructively:
+            held = self.server.hmget(self.PENDING_IDS, values)
+            for (entry_id, value), ids in zip(entries, held):
+                pending_ids.setdefault(value, ids.split(',') if ids else []).append(entry_id)
+        with self.server.pipeline() as pipe:
+            pipe.multi()
+            for entry_id, value in entries:
+                if destructively:
+                    pipe.execute_command('XACK', self.STREAM_KEY, self.group, entry_id)
+                    pipe.execute_command('XDEL', self.STREAM_KEY, entry_id)
+                if destructively or not self.keep_working_entry_set:
+                    pipe.srem(self.ENTRY_SET_KEY, value)
+            for value, ids in pending_ids.items():
+                pipe.hset(self.PENDING_IDS, value, ','.join(ids))
+            pipe.hmget(self.PAYLOADS, values)
+            payloads = pipe.execute()[-1]
+        results = []
+        for value, payload in zip(values, payloads):
+            payload = self.unpack(payload)
+            value = self.unpack(value)
+            results.append((value, payload) if return_key else payload or value)
+        return results
+
+    def pop(self, destructively=False, return_key=False, blocking=False):
+        popped = self.pop_many(1, destructively, return_key, block_ms=0 if blocking else None)
+        if popped:
+            return popped[0]
+        return (None, None) if return_key else None
+
+    def peek(self):
+        self._on_activity()
+        last_id = '0-0'
+        for group in self._command('XINFO', 'GROUPS', self.STREAM_KEY):
+            if not isinstance(group, dict):
+                group = dict(zip(group[::2], group[1::2]))
+            if group['name'] == self.group:
+                last_id = group['last-delivered-id']
+        entries = self._entries(self.server.execute_command('XRANGE', self.STREAM_KEY, '(' + last_id, '+', 'COUNT', 1))
+        return self.unpack(entries[0][1]) if entries else None
+
+    def _acknowledge(self, value, pipe):
+        """
+        Acknowledge every copy of value this worker has in progress, like Queue's LREM on its working list.
+        """
+        ids = self.server.hget(self.PENDING_IDS, value)
+        if ids:
+            entry_ids = ids.split(',')
+            pipe.execute_command('XACK', self.STREAM_KEY, self.group, *entry_ids)
+            pipe.execute_command('XDEL', self.STREAM_KEY, *entry_ids)
+            pipe.hdel(self.PENDING_IDS, value)
+
+    def complete(self, value, result=None):
+        """
+        Mark an item as complete, acknowledging its stream entries.
+        Otherwise behaves like Queue.complete().
+        """
+        self._on_activity()
+        if self.track_add_attempts and self.server.srem(self.ADD_ATTEMPTS_SET, value):
+            with self.server.pipeline() as pipe:
+                value = self.pack(value)
+                self._acknowledge(value, pipe)
+                self.push(value, pipeline=pipe, check=False)
+        else:
+            with self.server.pipeline() as pipe:
+                value = self.pack(value)
+                payload = self.server.hget(self.PAYLOADS, value)
+                self._acknowledge(value, pipe)
+                pipe.srem(self.ENTRY_SET_KEY, value)
+                pipe.hdel(self.PAYLOADS, value)
+                if result and result in self.pipes:
+                    self.pipes[result].push(value, payload=payload, pipeline=pipe)
+                pipe.execute()
+
+    def unpop(self, value):
+        self._on_activity()
+        packed = self.pack(value)
+        with self.server.pipeline() as pipe:
+            pipe.multi()
+            self._acknowledge(packed, pipe)
+            pipe.execute_command('XADD', self.STREAM_KEY, '*', 'value', packed)
+            if self.keep_entry_set:
+                pipe.sadd(self.ENTRY_SET_KEY, packed)
+            pipe.execute()
+
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()